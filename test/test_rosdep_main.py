@@ -26,41 +26,59 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from contextlib import contextmanager
+import functools
+from io import StringIO
 import os
 import sys
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from io import StringIO
-
-import rospkg
 
 import unittest
 from unittest.mock import DEFAULT, patch
 
+from rospkg.os_detect import OsNotDetected
+
 from rosdep2 import create_default_installer_context
 from rosdep2 import main
 from rosdep2.ament_packages import AMENT_PREFIX_PATH_ENV_VAR
 from rosdep2.main import rosdep_main
 from rosdep2.main import setup_proxy_opener
+from rosdep2.sources_list import load_cached_sources_list
+from rosdep2.url_utils import URLError
 
 
 GITHUB_BASE_URL = 'https://github.com/ros/rosdistro/raw/master/rosdep/base.yaml'
 GITHUB_PYTHON_URL = 'https://github.com/ros/rosdistro/raw/master/rosdep/python.yaml'
 
-
+# output of simulated 'install' for the catkin test tree
+EXPECTED_APT_INSTALL = frozenset([
+    '#[apt] Installation commands:',
+    '  sudo -H apt-get install ros-fuerte-catkin',
+    '  sudo -H apt-get install libboost1.40-all-dev',
+    '  sudo -H apt-get install libeigen3-dev',
+    '  sudo -H apt-get install libtinyxml-dev',
+    '  sudo -H apt-get install libltdl-dev',
+    '  sudo -H apt-get install libtool',
+    '  sudo -H apt-get install libcurl4-openssl-dev',
+])
+# 'test' and 'doc' dependency keys of multi_dep_type_catkin_package
+EXPECTED_MULTI_DEP_TYPE_KEYS = frozenset(['curl', 'epydoc'])
+
+
+@functools.lru_cache(maxsize=None)
 def get_test_dir():
     return os.path.abspath(os.path.dirname(__file__))
 
 
+@functools.lru_cache(maxsize=None)
 def get_test_tree_dir():
     return os.path.abspath(os.path.join(get_test_dir(), 'tree'))
 
 
+@functools.lru_cache(maxsize=None)
 def get_test_catkin_tree_dir():
     return os.path.abspath(os.path.join(get_test_tree_dir(), 'catkin'))
 
 
+@functools.lru_cache(maxsize=None)
 def get_cache_dir():
     p = os.path.join(get_test_dir(), 'sources_cache')
     assert os.path.isdir(p)
@@ -75,9 +93,11 @@ def fakeout():
     fakestderr = StringIO()
     sys.stdout = fakestdout
     sys.stderr = fakestderr
-    yield fakestdout, fakestderr
-    sys.stdout = realstdout
-    sys.stderr = realstderr
+    try:
+        yield fakestdout, fakestderr
+    finally:
+        sys.stdout = realstdout
+        sys.stderr = realstderr
 
 # the goal of these tests is only to test that we are wired into the
 # APIs.  More exhaustive tests are at the unit level.
@@ -85,85 +105,127 @@ def fakeout():
 
 class TestRosdepMain(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # parse the sources cache only once and hand the same data to
+        # every rosdep_main() invocation of this test case
+        cls._sources_cache = get_cache_dir()
+        sources = load_cached_sources_list(sources_cache_dir=cls._sources_cache)
+        cls._sources_by_dir = {cls._sources_cache: sources}
+        # likewise detect the OS only once, see setUp(); tests which pass
+        # --os themselves must keep working where detection fails
+        try:
+            context = create_default_installer_context()
+            os_detect = context.get_os_detect()
+            cls._os_override = '%s:%s' % context.get_os_name_and_version()
+            cls._ros_os_override = ':'.join([os_detect.get_name(), os_detect.get_version(), os_detect.get_codename()])
+        except OsNotDetected:
+            cls._os_override = cls._ros_os_override = None
+        # no test is supposed to reach the network, every download goes
+        # through urlopen_gzip(), see _assert_no_network_access()
+        cls._patchers = [
+            patch('rosdep2.sources_list.load_cached_sources_list', side_effect=cls._load_cached_sources_list),
+            patch('rosdep2.url_utils.urlopen', side_effect=URLError('network access is disabled in TestRosdepMain')),
+        ]
+        mocks = [patcher.start() for patcher in cls._patchers]
+        cls._urlopen = mocks[-1]
+
+    @classmethod
+    def tearDownClass(cls):
+        for patcher in reversed(cls._patchers):
+            patcher.stop()
+
+    @classmethod
+    def _load_cached_sources_list(cls, sources_cache_dir=None, verbose=False):
+        # cache per directory so that the sources cache passed with '-c'
+        # still has to reach the loader
+        if sources_cache_dir not in cls._sources_by_dir:
+            cls._sources_by_dir[sources_cache_dir] = load_cached_sources_list(
+                sources_cache_dir=sources_cache_dir, verbose=verbose)
+        return cls._sources_by_dir[sources_cache_dir]
+
     def setUp(self):
-        if 'ROSDEP_DEBUG' in os.environ:
-            del os.environ['ROSDEP_DEBUG']
-        self.old_rr = rospkg.get_ros_root()
-        self.old_rpp = rospkg.get_ros_package_path()
-        self.old_app = os.getenv(AMENT_PREFIX_PATH_ENV_VAR, None)
-        if 'ROS_ROOT' in os.environ:
-            del os.environ['ROS_ROOT']
-        os.environ['ROS_PACKAGE_PATH'] = os.path.join(get_test_tree_dir())
-        os.environ[AMENT_PREFIX_PATH_ENV_VAR] = os.path.join(get_test_tree_dir(), 'ament')
-        if 'ROS_PYTHON_VERSION' not in os.environ:
+        # patch.dict() restores the environment on stop(), including the
+        # variables rosdep_main() itself sets (e.g. ROS_DISTRO)
+        env = {
+            'ROS_PACKAGE_PATH': get_test_tree_dir(),
+            AMENT_PREFIX_PATH_ENV_VAR: os.path.join(get_test_tree_dir(), 'ament'),
             # avoid `test_check` failure due to warning on stderr
-            os.environ['ROS_PYTHON_VERSION'] = sys.version[0]
-
-    def tearDown(self):
-        if self.old_rr is not None:
-            os.environ['ROS_ROOT'] = self.old_rr
-        if self.old_rpp is not None:
-            os.environ['ROS_PACKAGE_PATH'] = self.old_rpp
-        if self.old_app is not None:
-            os.environ[AMENT_PREFIX_PATH_ENV_VAR] = self.old_app
+            'ROS_PYTHON_VERSION': os.environ.get('ROS_PYTHON_VERSION', sys.version[0]),
+        }
+        if self._ros_os_override is not None:
+            # every OsDetect instance created by rosdep_main() would probe
+            # the system again (os-release, lsb_release, ...), so hand the
+            # OS detected in setUpClass() to rospkg instead
+            env['ROS_OS_OVERRIDE'] = self._ros_os_override
+        env_patcher = patch.dict(os.environ, env)
+        env_patcher.start()
+        self.addCleanup(env_patcher.stop)
+        for key in ('ROSDEP_DEBUG', 'ROS_ROOT'):
+            os.environ.pop(key, None)
+        # rospkg builds a rosdep view from the default sources cache the
+        # first time a manifest is parsed in a process and warns on stderr
+        # if it is empty; disable that view for every test regardless of
+        # which test happens to parse a manifest first
+        view_patcher = patch('rospkg.manifest._static_rosdep_view', False)
+        view_patcher.start()
+        self.addCleanup(view_patcher.stop)
+        # rosdep turns download errors into messages or exit codes, so check
+        # for network access separately once the test is done
+        self._urlopen.reset_mock()
+        self.addCleanup(self._assert_no_network_access)
+
+    def _assert_no_network_access(self):
+        urls = [getattr(args[0], 'full_url', args[0]) for args, _ in self._urlopen.call_args_list]
+        self.assertFalse(urls, 'unexpected network access: %s' % ', '.join(urls))
+
+    def _run(self, args):
+        return rosdep_main(args + ['-c', self._sources_cache])
+
+    def _expect_no_exit(self, args):
+        """Run rosdep with *args*, failing the test if it exits; returns the captured (stdout, stderr)."""
+        with fakeout() as (stdout, stderr):
+            try:
+                self._run(args)
+            except SystemExit as e:
+                self.fail('system exit occurred (%s): %s\n%s' % (e.code, stdout.getvalue(), stderr.getvalue()))
+        return stdout, stderr
 
     def test_bad_commands(self):
-        sources_cache = get_cache_dir()
-        cmd_extras = ['-c', sources_cache]
         for commands in [[], ['fake', 'something'], ['check'], ['install', '-a', 'rospack_fake'],
                          ['check', 'rospack_fake', '--os', 'ubuntulucid'],
                          ]:
-            try:
-                rosdep_main(commands + cmd_extras)
-                assert False, 'system exit should have occurred'
-            except SystemExit:
-                pass
+            with self.subTest(commands=commands):
+                with self.assertRaises(SystemExit):
+                    self._run(commands)
 
     def test_check(self):
-        sources_cache = get_cache_dir()
-        cmd_extras = ['-c', sources_cache]
-
-        with fakeout() as b:
-            try:
-                rosdep_main(['check', 'python_dep'] + cmd_extras)
-            except SystemExit:
-                assert False, 'system exit occurred: %s\n%s' % (b[0].getvalue(), b[1].getvalue())
-
-            stdout, stderr = b
-            assert stdout.getvalue().strip() == 'All system dependencies have been satisfied', stdout.getvalue()
-        try:
-            context = create_default_installer_context()
-            override = '%s:%s' % context.get_os_name_and_version()
-            with fakeout() as b:
-                rosdep_main(['check', 'python_dep', '--os', override] + cmd_extras)
-                stdout, stderr = b
-                assert stdout.getvalue().strip() == 'All system dependencies have been satisfied'
-        except SystemExit:
-            assert False, 'system exit occurred'
+        stdout, stderr = self._expect_no_exit(['check', 'python_dep'])
+        assert stdout.getvalue().strip() == 'All system dependencies have been satisfied', stdout.getvalue()
+        stdout, stderr = self._expect_no_exit(['check', 'python_dep', '--os', self._os_override])
+        assert stdout.getvalue().strip() == 'All system dependencies have been satisfied'
 
         # this used to abort, but now rosdep assumes validity for even empty stack args
-        try:
-            with fakeout() as b:
-                rosdep_main(['check', 'packageless'] + cmd_extras)
-                stdout, stderr = b
-                assert stdout.getvalue().strip() == 'All system dependencies have been satisfied'
-        except SystemExit:
-            assert False, 'system exit occurred'
+        stdout, stderr = self._expect_no_exit(['check', 'packageless'])
+        assert stdout.getvalue().strip() == 'All system dependencies have been satisfied'
 
-        try:
-            rosdep_main(['check', 'nonexistent'] + cmd_extras)
-            assert False, 'system exit should have occurred'
-        except SystemExit:
-            pass
+        with self.assertRaises(SystemExit):
+            self._run(['check', 'nonexistent'])
 
     @patch('rosdep2.platforms.debian.read_stdout')
     @patch('rosdep2.installers.os.geteuid', return_value=1)
     def test_install(self, mock_geteuid, mock_read_stdout):
-        sources_cache = get_cache_dir()
-        cmd_extras = ['-c', sources_cache]
         catkin_tree = get_test_catkin_tree_dir()
+        # rosdep queries the same packages over and over again
+        read_stdout_cache = {}
 
         def read_stdout(cmd, capture_stderr=False):
+            key = (tuple(cmd), capture_stderr)
+            if key not in read_stdout_cache:
+                read_stdout_cache[key] = _read_stdout(cmd, capture_stderr)
+            return read_stdout_cache[key]
+
+        def _read_stdout(cmd, capture_stderr):
             if cmd[0] == 'apt-cache' and cmd[1] == 'showpkg':
                 result = ''
             elif cmd[0] == 'dpkg-query':
@@ -176,141 +238,75 @@ class TestRosdepMain(unittest.TestCase):
                 return result, ''
             return result
 
-        try:
-            mock_read_stdout.side_effect = read_stdout
-            # python must have already been installed
-            with fakeout() as b:
-                rosdep_main(['install', 'python_dep'] + cmd_extras)
-                stdout, stderr = b
-                assert 'All required rosdeps installed' in stdout.getvalue(), stdout.getvalue()
-            with fakeout() as b:
-                rosdep_main(['install', 'python_dep', '-r'] + cmd_extras)
-                stdout, stderr = b
-                assert 'All required rosdeps installed' in stdout.getvalue(), stdout.getvalue()
-            with fakeout() as b:
-                rosdep_main([
-                    'install', '-s', '-i',
-                    '--os', 'ubuntu:lucid',
-                    '--rosdistro', 'fuerte',
-                    '--from-paths', catkin_tree
-                ] + cmd_extras)
-                stdout, stderr = b
-                expected = [
-                    '#[apt] Installation commands:',
-                    '  sudo -H apt-get install ros-fuerte-catkin',
-                    '  sudo -H apt-get install libboost1.40-all-dev',
-                    '  sudo -H apt-get install libeigen3-dev',
-                    '  sudo -H apt-get install libtinyxml-dev',
-                    '  sudo -H apt-get install libltdl-dev',
-                    '  sudo -H apt-get install libtool',
-                    '  sudo -H apt-get install libcurl4-openssl-dev',
-                ]
-                lines = stdout.getvalue().splitlines()
-                assert set(lines) == set(expected), lines
-        except SystemExit:
-            assert False, 'system exit occurred: ' + b[1].getvalue()
-        try:
+        mock_read_stdout.side_effect = read_stdout
+        # python must have already been installed
+        stdout, stderr = self._expect_no_exit(['install', 'python_dep'])
+        assert 'All required rosdeps installed' in stdout.getvalue(), stdout.getvalue()
+        stdout, stderr = self._expect_no_exit(['install', 'python_dep', '-r'])
+        assert 'All required rosdeps installed' in stdout.getvalue(), stdout.getvalue()
+        stdout, stderr = self._expect_no_exit([
+            'install', '-s', '-i',
+            '--os', 'ubuntu:lucid',
+            '--rosdistro', 'fuerte',
+            '--from-paths', catkin_tree
+        ])
+        lines = stdout.getvalue().splitlines()
+        assert frozenset(lines) == EXPECTED_APT_INSTALL, lines
+
+        with self.assertRaises(SystemExit):
             rosdep_main(['install', 'nonexistent'])
-            assert False, 'system exit should have occurred'
-        except SystemExit:
-            pass
 
     def test_where_defined(self):
-        try:
-            sources_cache = get_cache_dir()
-            expected = GITHUB_PYTHON_URL
-            for command in (['where_defined', 'testpython'], ['where_defined', 'testpython']):
-                with fakeout() as b:
-                    # set os to ubuntu so this test works on different platforms
-                    rosdep_main(command + ['-c', sources_cache, '--os=ubuntu:lucid'])
-                    stdout, stderr = b
-                    output = stdout.getvalue().strip()
-                    assert output == expected, output
-        except SystemExit:
-            assert False, 'system exit occurred'
+        expected = GITHUB_PYTHON_URL
+        for command in (['where_defined', 'testpython'], ['where_defined', 'testpython']):
+            # set os to ubuntu so this test works on different platforms
+            stdout, stderr = self._expect_no_exit(command + ['--os=ubuntu:lucid'])
+            output = stdout.getvalue().strip()
+            assert output == expected, output
 
     def test_what_needs(self):
-        try:
-            sources_cache = get_cache_dir()
-            cmd_extras = ['-c', sources_cache]
-            expected = ['python_dep']
-            with fakeout() as b:
-                rosdep_main(['what-needs', 'testpython'] + cmd_extras)
-                stdout, stderr = b
-                output = stdout.getvalue().strip()
-                assert output.split('\n') == expected
-            expected = ['python_dep']
-            with fakeout() as b:
-                rosdep_main(['what_needs', 'testpython', '--os', 'ubuntu:lucid', '--verbose'] + cmd_extras)
-                stdout, stderr = b
-                output = stdout.getvalue().strip()
-                assert output.split('\n') == expected
-        except SystemExit:
-            assert False, 'system exit occurred'
+        expected = ['python_dep']
+        stdout, stderr = self._expect_no_exit(['what-needs', 'testpython'])
+        output = stdout.getvalue().strip()
+        assert output.split('\n') == expected
+        expected = ['python_dep']
+        stdout, stderr = self._expect_no_exit(['what_needs', 'testpython', '--os', 'ubuntu:lucid', '--verbose'])
+        output = stdout.getvalue().strip()
+        assert output.split('\n') == expected
 
     def test_keys(self):
-        sources_cache = get_cache_dir()
-        cmd_extras = ['-c', sources_cache]
-
-        try:
-            with fakeout() as b:
-                rosdep_main(['keys', 'rospack_fake'] + cmd_extras)
-                stdout, stderr = b
-                assert stdout.getvalue().strip() == 'testtinyxml', stdout.getvalue()
-                assert not stderr.getvalue(), stderr.getvalue()
-            with fakeout() as b:
-                rosdep_main(['keys', 'rospack_fake', '--os', 'ubuntu:lucid', '--verbose'] + cmd_extras)
-                stdout, stderr = b
-                assert stdout.getvalue().strip() == 'testtinyxml', stdout.getvalue()
-            with fakeout() as b:
-                rosdep_main(['keys', 'another_catkin_package'] + cmd_extras + ['-i'])
-                stdout, stderr = b
-                assert stdout.getvalue().strip() == 'catkin', stdout.getvalue()
-            with fakeout() as b:
-                rosdep_main(['keys', 'multi_dep_type_catkin_package', '-t', 'test', '-t', 'doc'] + cmd_extras)
-                stdout, stderr = b
-                output_keys = set(stdout.getvalue().split())
-                expected_keys = set(['curl', 'epydoc'])
-                assert output_keys == expected_keys, stdout.getvalue()
-        except SystemExit:
-            assert False, 'system exit occurred'
-        try:
-            rosdep_main(['keys', 'nonexistent'] + cmd_extras)
-            assert False, 'system exit should have occurred'
-        except SystemExit:
-            pass
+        stdout, stderr = self._expect_no_exit(['keys', 'rospack_fake'])
+        assert stdout.getvalue().strip() == 'testtinyxml', stdout.getvalue()
+        assert not stderr.getvalue(), stderr.getvalue()
+        stdout, stderr = self._expect_no_exit(['keys', 'rospack_fake', '--os', 'ubuntu:lucid', '--verbose'])
+        assert stdout.getvalue().strip() == 'testtinyxml', stdout.getvalue()
+        stdout, stderr = self._expect_no_exit(['keys', 'another_catkin_package', '-i'])
+        assert stdout.getvalue().strip() == 'catkin', stdout.getvalue()
+        stdout, stderr = self._expect_no_exit(['keys', 'multi_dep_type_catkin_package', '-t', 'test', '-t', 'doc'])
+        output_keys = frozenset(stdout.getvalue().split())
+        assert output_keys == EXPECTED_MULTI_DEP_TYPE_KEYS, stdout.getvalue()
+
+        with self.assertRaises(SystemExit):
+            self._run(['keys', 'nonexistent'])
 
     def test_search(self):
-        sources_cache = get_cache_dir()
-        cmd_extras = ['-c', sources_cache]
-
-        try:
-            with fakeout() as b:
-                rosdep_main(['search', 'curl', '--os=debian:squeeze'] + cmd_extras)
-                stdout, stderr = b
-                assert 'Closest keys' in stdout.getvalue(), stdout.getvalue()
-                assert 'curl' in stdout.getvalue(), stdout.getvalue()
-                assert 'Closest packages' not in stdout.getvalue(), stdout.getvalue()
-                assert not stderr.getvalue(), stderr.getvalue()
-            with fakeout() as b:
-                rosdep_main(['search', 'libeigen3-dev', '--os=ubuntu:noble'] + cmd_extras)
-                stdout, stderr = b
-                assert 'Closest keys' not in stdout.getvalue(), stdout.getvalue()
-                assert 'Closest packages' in stdout.getvalue(), stdout.getvalue()
-                assert 'eigen:' in stdout.getvalue(), stdout.getvalue()
-                assert not stderr.getvalue(), stderr.getvalue()
-        except SystemExit:
-            assert False, 'system exit occurred'
-        try:
-            rosdep_main(['search', 'libeigen3-dev', '--os=debian:squeeze'] + cmd_extras)
-            assert False, 'system exit should have occurred'
-        except SystemExit:
-            pass
-        try:
-            rosdep_main(['search', 'nonexistent'] + cmd_extras + ['-i'])
-            assert False, 'system exit should have occurred'
-        except SystemExit:
-            pass
+        stdout, stderr = self._expect_no_exit(['search', 'curl', '--os=debian:squeeze'])
+        output, error = stdout.getvalue(), stderr.getvalue()
+        assert 'Closest keys' in output, output
+        assert 'curl' in output, output
+        assert 'Closest packages' not in output, output
+        assert not error, error
+        stdout, stderr = self._expect_no_exit(['search', 'libeigen3-dev', '--os=ubuntu:noble'])
+        output, error = stdout.getvalue(), stderr.getvalue()
+        assert 'Closest keys' not in output, output
+        assert 'Closest packages' in output, output
+        assert 'eigen:' in output, output
+        assert not error, error
+
+        with self.assertRaises(SystemExit):
+            self._run(['search', 'libeigen3-dev', '--os=debian:squeeze'])
+        with self.assertRaises(SystemExit):
+            self._run(['search', 'nonexistent', '-i'])
 
     @patch('rosdep2.main.install_opener')
     @patch('rosdep2.main.build_opener')
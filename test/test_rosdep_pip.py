@@ -37,6 +37,7 @@ def get_test_dir():
     return os.path.abspath(os.path.join(os.path.dirname(__file__), 'pip'))
 
 
+@patch.dict(os.environ, {'ROS_PYTHON_VERSION': sys.version[0]})
 def test_pip_detect():
     from rosdep2.platforms.pip import pip_detect
 
@@ -67,6 +68,7 @@ def test_PipInstaller_get_depends():
     assert ['foo'] == installer.get_depends(dict(depends=['foo']))
 
 
+@patch.dict(os.environ, {'ROS_PYTHON_VERSION': sys.version[0]})
 @patch('rosdep2.platforms.pip.externally_managed_installable')
 def test_PipInstaller_handles_externally_managed_environment(externally_managed_installable):
     from rosdep2 import InstallFailed